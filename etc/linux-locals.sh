@@ -11,6 +11,7 @@ PREFIX="$HOME/.local"
 mkdir -p $PREFIX/share/zsh/site-functions
 
 DOTFILES_TMPDIR="${TMPDIR:-/tmp}/$USER/linux-locals"
+DOTFILES_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")/.." && pwd)"
 
 COLOR_NONE="\033[0m"
 COLOR_RED="\033[0;31m"
@@ -48,34 +49,14 @@ _template_github_latest() {
   fi
 
   echo -e "${COLOR_YELLOW}Installing $name from $repo ... ${COLOR_NONE}"
-  local releases_url="https://api.github.com/repos/${repo}/releases"
-  echo -e "${COLOR_YELLOW}Reading: ${COLOR_NONE}$releases_url"
-  local download_url=$(\
-    curl -fsSL "$releases_url" \
-    | python3 -c "\
-import json, sys, fnmatch;
-I = sys.stdin.read()
-assert I, 'empty output: check curl error messages'
-try:
-  J = json.loads(I)
-except:
-  sys.stderr.write(I)
-  raise
-for asset in J[0]['assets']:
-  if fnmatch.fnmatch(asset['name'], '$filename'):
-    print(asset['browser_download_url'])
-    sys.exit(0)
-sys.stderr.write('ERROR: Cannot find a download matching \'$filename\'.\n'); sys.exit(1)
-")
-  echo -e "${COLOR_YELLOW}download_url = ${COLOR_NONE}${download_url:-ERROR}"
-  test -n "${download_url}"
-  sleep 0.5
 
+  # Release metadata and assets are downloaded via (and cached by) `dotfiles download-asset`,
+  # see ~/.cache/dotfiles
   local tmpdir="$DOTFILES_TMPDIR/$name"
-  local filename="$(basename $download_url)"
+  local downloaded="$(python3 "$DOTFILES_DIR/bin/dotfiles" download-asset "$repo" "$filename" -o "$tmpdir")"
+  test -n "$downloaded"
+  local filename="$(basename $downloaded)"
   test -n "$filename"
-  mkdir -p $tmpdir
-  curl -fSL --progress-bar "$download_url" -o "$tmpdir/$filename"
 
   cd "$tmpdir"
   if [[ "$filename" == *.tar.gz ]]; then
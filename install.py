@@ -12,10 +12,10 @@
 
    https://dotfiles.wook.kr/
 '''
-print(__doc__)  # print logo.
 
 
 import os
+import time
 import argparse
 parser = argparse.ArgumentParser()
 parser.add_argument('-f', '--force', action="store_true", default=False,
@@ -24,8 +24,34 @@ parser.add_argument('--skip-vimplug', action='store_true',
                     help='If set, do not update vim plugins.')
 parser.add_argument('--skip-zplug', action='store_true',
                     help='If set, skip update of zsh plugins.')
+parser.add_argument('-j', '--jobs', type=int, default=min(8, os.cpu_count() or 1),
+                    help='The number of post actions to run concurrently.')
+parser.add_argument('--full', action='store_true', default=False,
+                    help='If set, run all post actions even if their inputs are unchanged '
+                         '(e.g. to update fzf to the latest release). The zsh and vim '
+                         'plugin updates always run, unless --skip-zplug/--skip-vimplug.')
+parser.add_argument('--affected-by', nargs='*', metavar='FILE', default=None,
+                    help='If set, only run the post actions whose inputs include any of '
+                         'the given files (e.g. changed by `dotfiles update`), '
+                         'and the ones that depend on them. The actions without '
+                         'inputs and the plugin updates always run.')
+parser.add_argument('--trace', default=os.path.expanduser('~/.cache/dotfiles/install-trace.jsonl'),
+                    help='A JSONL file to record the timing of the symlinks and post actions '
+                         '(the previous one is kept as *.prev.jsonl; see `dotfiles profile-install`).')
+parser.add_argument('--offline', action='store_true', default=None,
+                    help='Clone and fetch the git repositories (fzf, nvim plugins) from the local '
+                         'mirrors of `dotfiles bundle import`. The default is to use them only '
+                         'if github.com is not reachable.')
+parser.add_argument('-n', '--dry-run', action='store_true', default=False,
+                    help='If set, print the symlinks that would be changed (as a diff) '
+                         'and exit without changing anything. Exit code is 1 on conflicts.')
+parser.add_argument('--json', action='store_true', default=False,
+                    help='With --dry-run, print the plan in JSON (implies --dry-run).')
 
 args = parser.parse_args()
+args.dry_run = args.dry_run or args.json
+if not args.json:
+    print(__doc__)  # print logo.
 
 ################# BEGIN OF FIXME #################
 IS_SSH = os.getenv('SSH_TTY', None) is not None
@@ -102,9 +128,30 @@ __PATH__ = os.path.abspath(os.path.dirname(__file__))
 os.chdir(__PATH__)
 
 
+# Post actions, executed after the symlinks are created.
+# Each item is either a bash script (str) or a dict with the following keys:
+#   - action: the bash script to execute (str)
+#   - name: name of the action that other actions can refer to in `deps`
+#   - deps: names of actions that must be finished before this action starts
+#   - interactive: if True, runs with the terminal attached (may read stdin),
+#                  after all the preceding actions are done.
+#   - inputs: files, directories or submodules (relative to the repository)
+#             the action depends on. If given, the action is skipped when neither
+#             the script nor the inputs have changed since the last successful
+#             run (see STATE_FILE). Use --full to always run.
+#   - upstream: if True, the action updates from upstream (e.g. plugins), so
+#               it always runs, even with --affected-by (skip it with its own
+#               --skip-* option); its `inputs` only go into the fingerprints
+#               of the actions that depend on it.
+#   - outputs: files (with a '/', e.g. ~/.fzf/bin/fzf) or commands (on $PATH or
+#              ~/.local/bin) the action installs. The action is not skipped
+#              (by the fingerprint or --affected-by) if any of them is missing.
+# Actions without `inputs` always run, even with --affected-by.
+# Non-interactive actions whose deps are all done run concurrently (see --jobs),
+# and their outputs are buffered and printed in the order they are declared.
 post_actions = []
-post_actions += [  # Check symbolic link at $HOME
-    '''#!/bin/bash
+post_actions += [dict(  # Check symbolic link at $HOME
+    name='check-symlinks', interactive=True, action='''#!/bin/bash
     # Check whether ~/.vim and ~/.zsh are well-configured
     for f in ~/.vim ~/.zsh ~/.vimrc ~/.zshrc; do
         if ! readlink $f >/dev/null; then
@@ -117,12 +164,14 @@ Please remove your local folder/file $f and try again.\033[0m"
             echo "OK: $f --> $(readlink $f)"
         fi
     done
-''']
+''')]
 
-post_actions += [  # fzf
-    r'''#!/bin/bash
+post_actions += [dict(  # fzf
+    # the latest release as of the install; `install.py --full` to update
+    name='fzf', inputs=[], outputs=['~/.fzf/bin/fzf'], action=r'''#!/bin/bash
     # Install junegunn/fzf
     FZF_REPO="https://github.com/junegunn/fzf.git"
+    DOTFILES_BIN="$(pwd)/bin/dotfiles"
     if [[ ! -d "$HOME/.fzf" ]]; then
         git clone "$FZF_REPO" "$HOME/.fzf"
     else
@@ -136,25 +185,32 @@ post_actions += [  # fzf
           | sort -V | tail -n1)
     git checkout "$tag" || { echo "Checkout $tag failed. Check $HOME/.fzf" && exit 1; }
 
+    # Use the cached (or bundled, see `dotfiles bundle`) fzf binary, if available
+    if [[ "$(uname -sm)" == "Linux x86_64" ]]; then
+        fzf_tarball=$(python3 "$DOTFILES_BIN" download-asset junegunn/fzf 'fzf-*-linux_amd64.tar.gz' \
+                      -o "${TMPDIR:-/tmp}/$USER/fzf" 2>/dev/null) && tar -xzf "$fzf_tarball" -C bin/ || true
+    fi
+
     echo "Running: $ ./install --all --no-update-rc"
     ./install --all --no-update-rc
-''']
+''')]
 
-post_actions += [  # video2gif
-    '''#!/bin/bash
+post_actions += [dict(  # video2gif
+    name='video2gif', inputs=[], outputs=['~/.local/bin/video2gif'], action='''#!/bin/bash
     # Download command line scripts
     mkdir -p "$HOME/.local/bin/"
-    _download() {
-        curl -L "$2" > "$1" && chmod +x "$1"
+    _download() {  # via the download cache (see `dotfiles download`)
+        python3 bin/dotfiles download "$2" -o "$1" && chmod +x "$1"
     }
     ret=0
     set -v
     _download "$HOME/.local/bin/video2gif" "https://raw.githubusercontent.com/wookayin/video2gif/master/video2gif" || ret=1
     exit $ret;
-''']
+''')]
 
-post_actions += [  # antidote (zsh plugins)
-    '''#!/bin/bash
+post_actions += [dict(  # antidote (zsh plugins)
+    name='antidote', deps=['check-symlinks'], upstream=True,
+    inputs=['zsh/plugins.zsh', 'zsh/zshrc', 'zsh/antidote'], action='''#!/bin/bash
     # Update zsh bundles and cache (the init file)
     zsh -c "
         # source zsh plugin manager and list plugins
@@ -172,13 +228,15 @@ ERROR: antidote not found. Double check the submodule exists, and you have a val
     "
     ''' if not args.skip_zplug else \
         '# zsh plugins update (Skipped)'
-]
+)]
 
 post_actions += [  # tmux plugins
     # Install tmux plugins via tpm
-    '~/.tmux/plugins/tpm/bin/install_plugins',
+    dict(name='tpm', deps=['check-symlinks'],
+         inputs=['tmux/tmux.conf', 'tmux/plugins/tpm'],
+         action='~/.tmux/plugins/tpm/bin/install_plugins'),
 
-    r'''#!/bin/bash
+    dict(name='tmux', inputs=[], outputs=['tmux'], action=r'''#!/bin/bash
     # Check tmux version >= 3.2 (or use `dotfiles install tmux`)
     _version_check() {    # target_ver current_ver
         [ "$1" = "$(echo -e "$1\n$2" | sort -s -t- -k 2,2n | sort -t. -s -k 1,1n -k 2,2n | head -n1)" ]
@@ -196,10 +254,10 @@ post_actions += [  # tmux plugins
     else
         echo "$(which tmux): $(tmux -V)"
     fi
-''']
+''')]
 
-post_actions += [  # default shell
-    r'''#!/bin/bash
+post_actions += [dict(  # default shell
+    name='default-shell', interactive=True, action=r'''#!/bin/bash
     # Change default shell to zsh
     /bin/zsh --version >/dev/null || (\
         echo -e "\033[0;31mError: /bin/zsh not found. Please install zsh.\033[0m"; exit 1)
@@ -209,17 +267,18 @@ post_actions += [  # default shell
     else
         echo -e "\033[0;32m\$SHELL is already zsh.\033[0m $(zsh --version)"
     fi
-''']
+''')]
 
-post_actions += [  # patch and test TERMINFO
-    r'''#!/bin/bash
+post_actions += [dict(  # patch and test TERMINFO
+    name='terminfo', inputs=['etc/terminfo.sh', 'etc/terminfo'], action=r'''#!/bin/bash
     # Run etc/terminfo.sh to keep terminfo Up-to-date
     bash "etc/terminfo.sh" install
     '''
-]
+)]
 
-post_actions += [  # install some essential packages (linux)
-    '''#!/bin/bash
+post_actions += [dict(  # install some essential packages (linux)
+    name='local-packages', inputs=['etc/linux-locals.sh'],
+    outputs=['node', 'rg', 'fd', 'tree-sitter'], action='''#!/bin/bash
     # Check and install node, rg, fd locally
     export PATH="$PATH:$HOME/.local/bin"
     type node || bin/dotfiles install node
@@ -233,10 +292,10 @@ post_actions += [  # install some essential packages (linux)
         tree-sitter --version
     fi
     '''
-] if platform.system() == "Linux" else []
+)] if platform.system() == "Linux" else []
 
-post_actions += [  # macOS
-    '''#!/bin/bash
+post_actions += [dict(  # macOS
+    name='homebrew', inputs=[], outputs=['brew', 'tree-sitter'], action='''#!/bin/bash
     # macOS: homebrew installation
 
     # Allow local installation (as a fallback)
@@ -250,17 +309,21 @@ post_actions += [  # macOS
         tree-sitter --version
     fi
     '''
-] if platform.system() == "Darwin" else []
+)] if platform.system() == "Darwin" else []
 
-post_actions += [  # neovim
-    '''#!/bin/bash
+post_actions += [dict(  # neovim
+    # requires node, rg, fd (see above)
+    name='neovim', deps=['local-packages', 'homebrew'],
+    inputs=['etc/install-neovim.sh'], outputs=['nvim'], action='''#!/bin/bash
     PATH="$PATH:$HOME/.local/bin"
     bash "etc/install-neovim.sh"
-''']
+''')]
 
-post_actions += [  # vim-plug
-    # Run lazy.nvim installation
-    {'update'  : '''# vim plugins: install and update via Lazy
+post_actions += [dict(  # vim-plug
+    # Run lazy.nvim installation (requires neovim and tree-sitter)
+    name='vim-plug', deps=['check-symlinks', 'local-packages', 'homebrew', 'neovim'],
+    upstream=True, inputs=['nvim/lua/config/plugins.lua', 'nvim/lua/plugins'],
+    action={'update'  : '''# vim plugins: install and update via Lazy
         PATH="$PATH:$HOME/.local/bin" \
         nvim --headless \
             -c "lua require('lazy').update { wait = true }" \
@@ -275,10 +338,10 @@ post_actions += [  # vim-plug
         rm -fv ~/.vim/plugged/*.cloning
     fi
     '''
-]
+)]
 
-post_actions += [  # gitconfig.secret
-    r'''#!/bin/bash
+post_actions += [dict(  # gitconfig.secret
+    name='gitconfig-secret', interactive=True, action=r'''#!/bin/bash
     # Create ~/.gitconfig.secret file and check user configuration
     if [ ! -f ~/.gitconfig.secret ]; then
         cat > ~/.gitconfig.secret <<EOL
@@ -307,7 +370,7 @@ EOL
     echo -en 'user.name  : '; git config --file ~/.gitconfig.secret user.name
     echo -en 'user.email : '; git config --file ~/.gitconfig.secret user.email
     echo -en '\033[0m';
-''']
+''')]
 
 
 ################# END OF FIXME #################
@@ -326,6 +389,7 @@ BLUE   = _wrap_colors("\033[0;34m")
 
 import os
 import sys
+import binascii
 import subprocess
 
 from signal import signal, SIGPIPE, SIG_DFL
@@ -364,15 +428,196 @@ def makedirs(target, mode=511, exist_ok=False):
         if ex.errno == errno.EEXIST and exist_ok: pass
         else: raise
 
+class Tracer(object):
+    """Records the timing of the install steps, written as JSONL (see --trace).
+
+    An event is a dict: kind (install, phase, symlink, action), name,
+    start, end, seconds, and optionally exitcode, output_bytes and status."""
+
+    def __init__(self):
+        import threading
+        self.events = []
+        self._lock = threading.Lock()
+
+    def add(self, kind, name, start, end=None, **extra):
+        end = time.time() if end is None else end
+        event = dict(kind=kind, name=name, start=start, end=end,
+                     seconds=round(end - start, 6), **extra)
+        with self._lock:
+            self.events.append(event)
+        return event
+
+    def span(self, kind, name):
+        """A context manager to time a block."""
+        import contextlib
+        @contextlib.contextmanager
+        def _span():
+            start = time.time()
+            try:
+                yield
+            finally:
+                self.add(kind, name, start)
+        return _span()
+
+    def write(self, path):
+        import json
+        makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.replace(path, path[:-len('.jsonl')] + '.prev.jsonl'
+                       if path.endswith('.jsonl') else path + '.prev')
+        with open(path, 'w') as f:
+            for event in sorted(self.events, key=lambda e: e['start']):
+                f.write(json.dumps(event, sort_keys=True) + '\n')
+
+    def summary(self, limit=10):
+        """The slowest steps, as a table."""
+        events = sorted((e for e in self.events if e['kind'] in ('phase', 'action')
+                         and e.get('status', 'ran') == 'ran'),
+                        key=lambda e: -e['seconds'])[:limit]
+        return '\n'.join("{:>9.2f}s  {:<7} {}{}".format(
+            e['seconds'], e['kind'], e['name'],
+            '' if e.get('exitcode') in (None, 0) else '  (exit code: %d)' % e['exitcode'])
+            for e in events)
+
+tracer = Tracer()
+
 # get current directory (absolute path)
 current_dir = os.path.abspath(os.path.dirname(__file__))
 os.chdir(current_dir)
 
+def _gitdir(path):
+    """The git directory of a (sub)module worktree, e.g. .git/modules/<name>."""
+    gitdir = os.path.join(path, '.git')
+    if os.path.isfile(gitdir):  # "gitdir: ../.git/modules/<name>"
+        with open(gitdir) as f:
+            gitdir = os.path.join(path, f.read().split(':', 1)[1].strip())
+    return gitdir
+
+def _submodule_head(path):
+    """Read the HEAD commit of a submodule checkout without spawning git."""
+    gitdir = _gitdir(path)
+    try:
+        with open(os.path.join(gitdir, 'HEAD')) as f:
+            head = f.read().strip()
+        if not head.startswith('ref: '):
+            return head  # detached HEAD
+        ref = head[5:]
+        if os.path.isfile(os.path.join(gitdir, ref)):
+            with open(os.path.join(gitdir, ref)) as f:
+                return f.read().strip()
+        with open(os.path.join(gitdir, 'packed-refs')) as f:
+            for line in f:
+                if line.rstrip('\n').endswith(' ' + ref):
+                    return line.split()[0]
+    except IOError:
+        pass
+    return None
+
+def _read_gitlinks(index_path):
+    """Read the gitlinks (submodules) recorded in a git index file.
+
+    Returns a dict {path: (sha, stage)}, or None if the index cannot be read
+    (e.g. unknown index format, or a split index).
+    """
+    import struct
+    try:
+        with open(index_path, 'rb') as f:
+            data = f.read()
+    except IOError:
+        return None
+    if data[:4] != b'DIRC':
+        return None
+    version, count = struct.unpack('>II', data[4:12])
+    if version not in (2, 3, 4):
+        return None
+
+    gitlinks = {}
+    pos, path = 12, b''
+    for _ in range(count):
+        start = pos
+        mode, = struct.unpack('>I', data[pos + 24:pos + 28])
+        sha = data[pos + 40:pos + 60]
+        flags, = struct.unpack('>H', data[pos + 60:pos + 62])
+        pos += 62
+        if flags & 0x4000:  # extended flags (v3+)
+            pos += 2
+        if version == 4:  # prefix-compressed path
+            c = data[pos]; pos += 1
+            strip = c & 0x7f
+            while c & 0x80:
+                c = data[pos]; pos += 1
+                strip = ((strip + 1) << 7) | (c & 0x7f)
+            end = data.index(b'\0', pos)
+            path = path[:len(path) - strip] + data[pos:end]
+            pos = end + 1
+        else:  # NUL-terminated path, padded to a multiple of 8 bytes
+            end = data.index(b'\0', pos)
+            path = data[pos:end]
+            pos = start + ((pos - start + len(path) + 8) & ~7)
+        if (mode >> 12) == 0o16:  # gitlink (mode 160000)
+            name = path.decode('utf-8')
+            stage = max((flags >> 12) & 0x3, gitlinks.get(name, (None, 0))[1])
+            gitlinks[name] = (binascii.hexlify(sha).decode(), stage)
+
+    # split index: the entries are stored elsewhere
+    while pos + 8 <= len(data) - 20:
+        signature, size = data[pos:pos + 4], struct.unpack('>I', data[pos + 4:pos + 8])[0]
+        if signature == b'link':
+            return None
+        pos += 8 + size
+    return gitlinks
+
+def check_submodules(worktree, prefix=''):
+    """A fast health check of git submodules, without spawning git processes.
+
+    Compares the gitlinks recorded in the index with the HEAD of each submodule
+    (recursively), and returns a list of (path, status) where status is
+    one of '-' (not initialized), '+' (needs update) and 'U' (conflict),
+    just like `git submodule status`; or None if it cannot be determined.
+    """
+    gitlinks = _read_gitlinks(os.path.join(_gitdir(worktree), 'index'))
+    if gitlinks is None:
+        return None
+    issues = []
+    for path, (sha, stage) in sorted(gitlinks.items()):
+        subpath = os.path.join(worktree, path)
+        head = _submodule_head(subpath)
+        if stage != 0:
+            issues.append((prefix + path, 'U'))
+        elif head is None:
+            issues.append((prefix + path, '-'))
+        elif head != sha:
+            issues.append((prefix + path, '+'))
+        elif os.path.isfile(os.path.join(subpath, '.gitmodules')):
+            sub_issues = check_submodules(subpath, prefix=prefix + path + '/')
+            if sub_issues is None:
+                return None
+            issues += sub_issues
+    return issues
+
+def _git_submodule_status():
+    stat = subprocess.check_output(["git", "submodule", "status", "--recursive"],
+                                   universal_newlines=True)
+    return [(l.split()[1], l[0]) for l in stat.split('\n')  # noqa
+            if len(l) and l[0] != ' ']
+
+_install_start = time.time()
+
+if not args.dry_run:
+    import atexit
+    @atexit.register
+    def _write_trace():
+        tracer.add('install', 'install.py', _install_start)
+        try:
+            tracer.write(args.trace)
+        except (IOError, OSError) as e:
+            log(YELLOW("Cannot write the trace: %s" % e))
+
 # check if git submodules are loaded properly
-stat = subprocess.check_output("git submodule status --recursive",
-                               shell=True, universal_newlines=True)
-submodule_issues = [(l.split()[1], l[0]) for l in stat.split('\n')  # noqa
-                    if len(l) and l[0] != ' ']
+with tracer.span('phase', 'submodules'):
+    submodule_issues = check_submodules(current_dir)
+    if submodule_issues is None:  # fallback to git
+        submodule_issues = _git_submodule_status()
 
 if submodule_issues:
     stat_messages = {'+': 'needs update', '-': 'not initialized', 'U': 'conflict!'}
@@ -382,116 +627,486 @@ if submodule_issues:
             status=stat_messages.get(submodule_stat, '(Unknown)'))))
     log(YELLOW("Git submodules are not initialized.\n"))
 
-    update_submodule = True
+    update_submodule = not args.dry_run
     if update_submodule:
-        git_submodule_update_cmd = 'git submodule update --init --recursive'
+        git_submodule_update_cmd = ['git', 'submodule', 'update', '--init', '--recursive']
         # git 2.8+ supports parallel submodule fetching
         try:
-            git_version = str(subprocess.check_output(
-                """git --version | awk '{print $3}'""", shell=True))
-            if git_version >= '2.8':
-                git_submodule_update_cmd += ' --jobs 8'
+            git_version = subprocess.check_output(
+                ['git', '--version'], universal_newlines=True).split()[2]
+            if tuple(int(v) for v in git_version.split('.')[:2]) >= (2, 8):
+                git_submodule_update_cmd += ['--jobs', str(os.cpu_count() or 1)]
         except Exception:
             pass
-        log("Running: %s" % CYAN(git_submodule_update_cmd))
-        subprocess.call(git_submodule_update_cmd, shell=True)
+        log("Running: %s" % CYAN(' '.join(git_submodule_update_cmd)))
+        with tracer.span('phase', 'submodules:update'):
+            subprocess.call(git_submodule_update_cmd)
+    elif args.dry_run:
+        log(GRAY("(dry-run) git submodule update is skipped."))
     else:
         log(RED("Aborted."))
         sys.exit(1)
 
 
-log_boxed("Creating symbolic links", color_fn=CYAN)
-for target, item in sorted(tasks.items()):
-    # normalize paths
-    if isinstance(item, str):
-        item = {'src': item}
+def plan_symlinks(tasks, force_all=False):
+    """Inspect all the symlink targets (without modifying anything) and
+    return a list of operations to apply, in the order of targets.
+
+    Each operation is a dict with the following keys:
+      - op: one of 'create', 'replace', 'skip', 'conflict', 'remove'
+      - target, source: absolute paths (source is None for 'remove')
+      - reason: a human-readable message (for 'replace', 'skip' and 'conflict')
+      - mkdir: the parent directory to create before creating the symlink
+      - fatal: (conflict only) whether the installation should abort
+      - missing_source: (conflict only) whether the source does not exist
+    """
+    import stat as _stat
+    plan = []
+    new_dirs = set()
 
-    source = item.get('src', None)
-    force = item.get('force', False)
-    fail_on_error = item.get('fail_on_error', False)
+    for target, item in sorted(tasks.items()):
+        # normalize paths
+        if isinstance(item, str):
+            item = {'src': item}
 
-    if not item.get('cond', True):
-        continue
+        source = item.get('src', None)
+        force = item.get('force', False)
+        fail_on_error = item.get('fail_on_error', False)
 
-    if source:
-        source = os.path.join(current_dir, os.path.expanduser(source))
-    target = os.path.expanduser(target)
+        if not item.get('cond', True):
+            continue
+
+        if source:
+            source = os.path.join(current_dir, os.path.expanduser(source))
+        target = os.path.expanduser(target)
+
+        try:
+            st = os.lstat(target)
+        except OSError:  # FileNotFoundError
+            st = None
+        is_link = st is not None and _stat.S_ISLNK(st.st_mode)
+        link = os.readlink(target) if is_link else None
+
+        if item.get('action', None) == 'remove':
+            if st is not None:
+                plan.append(dict(op='remove', target=target, source=None))
+            continue
+
+        assert source is not None
+        # bad entry if source does not exists...
+        if force:
+            pass  # Even if the source does not exist, always make a symlink
+        elif not os.path.lexists(source):
+            plan.append(dict(op='conflict', target=target, source=source,
+                             reason="source %s : does not exist" % source,
+                             missing_source=True))
+            continue
+
+        entry = dict(op='create', target=target, source=source)
+        if st is not None:
+            # if --force option is given, delete and override the previous symlink
+            if is_link and not os.path.exists(link):  # broken link, safe to remove
+                entry.update(op='replace', reason="broken link to '%s'" % link)
+            elif is_link:
+                if force_all:
+                    entry.update(op='replace', reason="was a link to '%s'" % link)
+                elif link == source:
+                    entry.update(op='skip', reason="already exists, skipped")
+                else:
+                    entry.update(op='skip', reason="already exists (links to '%s'), skipped" % link)
+            elif fail_on_error:
+                entry.update(op='conflict', fatal=True,
+                             reason="already exists, please remove " + target + " manually.")
+            elif force_all:
+                entry.update(op='conflict', reason="already exists but not a symbolic link; --force option ignored")
+            else:
+                entry.update(op='conflict', reason="exists, but not a symbolic link. Check by yourself!!")
+
+        if entry['op'] in ('create', 'replace'):
+            mkdir_target = os.path.split(target)[0]
+            if mkdir_target not in new_dirs and not os.path.isdir(mkdir_target):
+                entry['mkdir'] = mkdir_target
+                new_dirs.add(mkdir_target)
+        plan.append(entry)
+
+    return plan
+
+def apply_symlink_plan(plan, tracer=None):
+    """Apply the operations from `plan_symlinks()`."""
+    for entry in plan:
+        if tracer is not None and entry['op'] in ('create', 'replace', 'remove'):
+            with tracer.span('symlink', entry['op'] + ' ' + entry['target']):
+                _apply_symlink(entry)
+        else:
+            _apply_symlink(entry)
 
-    if item.get('action', None) == 'remove':
+def _apply_symlink(entry):
+    op, target, source = entry['op'], entry['target'], entry['source']
+    if op == 'remove':
         try:
             os.unlink(target)
         except OSError:  # FileNotFoundError
             pass
-        continue
-
-    assert source is not None
-    # bad entry if source does not exists...
-    if force:
-        pass  # Even if the source does not exist, always make a symlink
-    elif not os.path.lexists(source):
-        log(RED("source %s : does not exist" % source))
-        continue
-
-    # if --force option is given, delete and override the previous symlink
-    if os.path.lexists(target):
-        is_broken_link = os.path.islink(target) and not os.path.exists(os.readlink(target))
-        err = ""
-
-        if is_broken_link:  # safe to remove
-            if os.path.islink(target):
-                os.unlink(target)
-
-        elif os.path.islink(target):
-            if args.force:
-                os.unlink(target)
-            else:
-                msg = GRAY("already exists, skipped")
-                log("{:60s} : {}".format(BLUE(target), msg))
-        elif fail_on_error:
-            err = RED("already exists, please remove " + target + " manually.")
+        return
+    elif op == 'skip':
+        log("{:60s} : {}".format(BLUE(target), GRAY(entry['reason'])))
+        return
+    elif op == 'conflict':
+        if entry.get('missing_source'):
+            log(RED(entry['reason']))
         else:
-            if args.force:
-                err = YELLOW("already exists but not a symbolic link; --force option ignored")
-            else:
-                err = YELLOW("exists, but not a symbolic link. Check by yourself!!")
-        if err:
-            log("{:60s} : {}".format(BLUE(target), err))
-            if fail_on_error:
-                sys.exit(1)
-
-    # make a symbolic link if available
-    if not os.path.lexists(target):
-        mkdir_target = os.path.split(target)[0]
-        if not os.path.isdir(mkdir_target):
-            makedirs(mkdir_target)
-            log(GREEN('Created directory : %s' % mkdir_target))
-        os.symlink(source, target)
-        log("{:60s} : {}".format(
-            BLUE(target),
-            GREEN("symlink created from '%s'" % source)
-        ))
-
-errors = []
-for action in post_actions:
-    if not action:
-        continue
+            color_fn = RED if entry.get('fatal') else YELLOW
+            log("{:60s} : {}".format(BLUE(target), color_fn(entry['reason'])))
+        if entry.get('fatal'):
+            sys.exit(1)
+        return
+
+    # the plan may have gone stale with the links made before this one, e.g.
+    # ~/.vim/autoload/plug.vim exists already once ~/.vim has been linked
+    if os.path.lexists(target) and os.path.realpath(target) == os.path.realpath(source):
+        log("{:60s} : {}".format(BLUE(target), GRAY("already exists (through a linked parent), skipped")))
+        return
+    if op == 'create' and os.path.lexists(target):
+        log("{:60s} : {}".format(BLUE(target), YELLOW("exists, but not a symbolic link. Check by yourself!!")))
+        return
+
+    # make a symbolic link
+    if op == 'replace':
+        try:
+            os.unlink(target)
+        except OSError:  # FileNotFoundError: removed since the plan was made
+            pass
+    if entry.get('mkdir') and not os.path.isdir(entry['mkdir']):
+        makedirs(entry['mkdir'], exist_ok=True)
+        log(GREEN('Created directory : %s' % entry['mkdir']))
+    os.symlink(source, target)
+    log("{:60s} : {}".format(
+        BLUE(target),
+        GREEN("symlink created from '%s'" % source)
+    ))
+
+def print_symlink_plan(plan, as_json=False):
+    """Print the plan as a diff (or JSON) to stdout, without applying it."""
+    if as_json:
+        import json
+        json.dump({'plan': plan}, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        return
+    for entry in plan:
+        op, target, source = entry['op'], entry['target'], entry['source']
+        if op == 'create':
+            line = GREEN("+ %s -> %s" % (target, source))
+        elif op == 'replace':
+            line = YELLOW("~ %s -> %s (%s)" % (target, source, entry['reason']))
+        elif op == 'remove':
+            line = RED("- %s" % target)
+        elif op == 'conflict':
+            line = RED("! %s : %s" % (target, entry['reason']))
+        else:
+            line = GRAY("  %s : %s" % (target, entry['reason']))
+        print(line)
+
 
+with tracer.span('phase', 'symlinks:plan'):
+    symlink_plan = plan_symlinks(tasks, force_all=args.force)
+if args.dry_run:
+    print_symlink_plan(symlink_plan, as_json=args.json)
+    sys.exit(1 if any(e['op'] == 'conflict' for e in symlink_plan) else 0)
+
+log_boxed("Creating symbolic links", color_fn=CYAN)
+with tracer.span('phase', 'symlinks:apply'):
+    apply_symlink_plan(symlink_plan, tracer=tracer)
+
+def _action_title(action):
     action_title = action.strip().split('\n')[0].strip()
     if action_title == '#!/bin/bash':
         action_title = action.strip().split('\n')[1].strip()
+    return action_title
 
-    log("\n", cr=False)
-    log_boxed("Executing: " + action_title, color_fn=CYAN)
-    exitcode = subprocess.call(
+# The fingerprints of post actions that have succeeded (see `inputs`).
+STATE_FILE = os.path.expanduser('~/.cache/dotfiles/install-state.json')
+
+def load_state(path=STATE_FILE):
+    import json
+    try:
+        with open(path) as f:
+            return json.load(f).get('fingerprints', {})
+    except (IOError, ValueError):
+        return {}
+
+def save_state(fingerprints, path=STATE_FILE):
+    import json
+    makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'fingerprints': fingerprints}, f, indent=2, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+def _fingerprint(action, inputs):
+    """A hash of the action script and the content of its inputs."""
+    import hashlib
+    h = hashlib.sha256(action.encode('utf-8'))
+    for path in inputs:
+        h.update(b'\0' + path.encode('utf-8') + b'\0')
+        if os.path.lexists(os.path.join(path, '.git')):  # submodule
+            h.update(str(_submodule_head(path)).encode())
+        elif os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for fname in sorted(files):
+                    fpath = os.path.join(root, fname)
+                    h.update(fpath.encode('utf-8') + b'\0')
+                    with open(fpath, 'rb') as f:
+                        h.update(f.read())
+        elif os.path.isfile(path):
+            with open(path, 'rb') as f:
+                h.update(f.read())
+        else:
+            h.update(b'(missing)')
+    return h.hexdigest()
+
+def _run_action(action, interactive=False):
+    """Run a post action script. Returns (exitcode, buffered output or None)."""
+    if interactive:
+        exitcode = subprocess.call(
+            ['bash', '-e', '-c', action],
+            preexec_fn=lambda: signal(SIGPIPE, SIG_DFL),
+        )
+        return exitcode, None
+    p = subprocess.Popen(
         ['bash', '-e', '-c', action],
+        stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
         preexec_fn=lambda: signal(SIGPIPE, SIG_DFL),
     )
-    if exitcode != 0:
-        errors.append(action_title)
-        log(RED("FAILED (exit code: %d): %s" % (exitcode, action_title)))
-    if exitcode == 100:  # FATAL, should abort
-        sys.exit(100)
+    output = p.communicate()[0]
+    return p.returncode, output
+
+def _missing_outputs(action):
+    """Whether any of the `outputs` of an action is missing."""
+    import shutil
+    path = os.pathsep.join([os.environ.get('PATH', ''), os.path.expanduser('~/.local/bin'),
+                            os.path.expanduser('~/.homebrew/bin')])
+    for output in action.get('outputs', []):
+        if '/' in output:
+            if not os.path.exists(os.path.expanduser(output)):
+                return True
+        elif shutil.which(output, path=path) is None:
+            return True
+    return False
+
+def run_post_actions(actions, jobs, state=None, full=False, affected=None,
+                     tracer=None):
+    """Execute post actions as a DAG (see `post_actions`) on a worker pool.
+
+    Returns a list of (action_title, exitcode), in the order of declaration.
+    Dependencies that do not exist (e.g. platform-specific actions) are ignored.
+    An action still runs even if its dependencies have failed, as before.
+
+    If `state` (a dict of action name -> fingerprint) is given, actions with
+    `inputs` are skipped when the fingerprint is unchanged (unless `full`),
+    except the `upstream` ones and the ones with missing `outputs`.
+    The dict is updated in place with the fingerprints of succeeded actions.
+
+    If `affected` (a list of changed files) is given, only the actions whose
+    `inputs` include any of them, and the ones depending on those, are run
+    (plus the `upstream` ones and the ones without `inputs`, always).
+
+    If `tracer` is given, the timing of every action is recorded in it.
+    """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+    # normalize actions
+    actions = [dict(action=a) if isinstance(a, str) else dict(a)
+               for a in actions]
+    actions = [a for a in actions if a.get('action')]
+    for a in actions:
+        a['title'] = _action_title(a['action'])
+        a.setdefault('name', a['title'])
+    names = set(a['name'] for a in actions)
+    for a in actions:
+        a['deps'] = [d for d in a.get('deps', []) if d in names]
+
+    # the dependency graph must be acyclic.
+    graph = {a['name']: a['deps'] for a in actions}
+    visiting, visited = set(), {}  # visited: an ordered set, deps first
+    def _visit(name):
+        if name in visited: return
+        if name in visiting:
+            raise ValueError("Cyclic dependency in post_actions: %s" % name)
+        visiting.add(name)
+        for d in graph[name]:
+            _visit(d)
+        visiting.discard(name)
+        visited[name] = True
+    for a in actions:
+        _visit(a['name'])
+
+    # fingerprints of incremental actions (including those of their deps),
+    # computed in a topological order.
+    fingerprints = {}
+    for name in visited:
+        a = next(a for a in actions if a['name'] == name)
+        if 'inputs' in a:
+            fingerprints[name] = _fingerprint(
+                a['action'] + ''.join(fingerprints.get(d, '') for d in a['deps']),
+                a['inputs'])
+
+    exitcodes = {}     # name -> exitcode
+    skipped = set()
+    unaffected = set()
+    if affected is not None:
+        def _is_affected(a):
+            if 'inputs' not in a or a.get('upstream') or _missing_outputs(a):
+                return True  # always run
+            return any(f == i or f.startswith(i.rstrip('/') + '/')
+                       for i in a['inputs'] for f in affected)
+        selected = set()
+        for name in visited:
+            a = next(a for a in actions if a['name'] == name)
+            if _is_affected(a) or any(d in selected for d in a['deps']):
+                selected.add(name)
+            else:
+                unaffected.add(name)
+                exitcodes[name] = 0
+    if state is not None and not full:
+        for name, fp in fingerprints.items():
+            a = next(a for a in actions if a['name'] == name)
+            if (name not in unaffected and not a.get('upstream') and state.get(name) == fp
+                    and not _missing_outputs(a)):
+                skipped.add(name)
+                exitcodes[name] = 0
+    if tracer is not None:
+        for name in skipped | unaffected:
+            now = time.time()
+            tracer.add('action', name, now, now, exitcode=0, status=(
+                'skipped' if name in skipped else 'unaffected'))
+
+    def _run(a, interactive=False):
+        start = time.time()
+        exitcode, output = _run_action(a['action'], interactive=interactive)
+        if tracer is not None:
+            tracer.add('action', a['name'], start, exitcode=exitcode, status='ran',
+                       output_bytes=None if output is None else len(output))
+        return exitcode, output
+
+    outputs = {}       # name -> buffered output
+    futures = {}       # future -> name
+    started = skipped | unaffected
+    num_printed = 0
+    aborted = False
+
+    def _log_header(a):
+        log("\n", cr=False)
+        log_boxed("Executing: " + a['title'], color_fn=CYAN)
+
+    def _flush(final=False):
+        # print the outputs of finished actions, in the order of declaration.
+        nonlocal num_printed
+        while num_printed < len(actions):
+            a = actions[num_printed]
+            if a['name'] not in exitcodes:
+                if not final: break
+                num_printed += 1
+                continue
+            if a['name'] in skipped:
+                log(GRAY("Skipped (unchanged): " + a['title']))
+            elif a['name'] in unaffected:
+                log(GRAY("Skipped (not affected): " + a['title']))
+            if a['name'] in outputs:
+                _log_header(a)
+                sys.stdout.flush()
+                getattr(sys.stdout, 'buffer', sys.stdout).write(outputs.pop(a['name']))
+                sys.stdout.flush()
+            exitcode = exitcodes[a['name']]
+            if exitcode != 0:
+                log(RED("FAILED (exit code: %d): %s" % (exitcode, a['title'])))
+            num_printed += 1
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        while True:
+            _flush()
+            if num_printed == len(actions):
+                break
+            if aborted and not futures:
+                _flush(final=True)
+                break
+
+            interactive = None
+            for i, a in enumerate(actions):
+                if aborted: break
+                if a['name'] in started or not all(d in exitcodes for d in a['deps']):
+                    continue
+                if a.get('interactive'):
+                    # needs the terminal: run when all the preceding ones are done.
+                    if i == num_printed:
+                        interactive = a
+                        break
+                    continue
+                started.add(a['name'])
+                futures[pool.submit(_run, a)] = a['name']
+
+            if interactive is not None:
+                a = interactive
+                started.add(a['name'])
+                _log_header(a)
+                exitcodes[a['name']], _ = _run(a, interactive=True)
+            elif futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = futures.pop(future)
+                    exitcodes[name], outputs[name] = future.result()
+            elif not aborted:
+                raise RuntimeError("post_actions cannot proceed; check deps: " +
+                                   str([a['name'] for a in actions if a['name'] not in started]))
+
+            if state is not None:
+                for name, exitcode in exitcodes.items():
+                    if name in fingerprints and name not in skipped | unaffected:
+                        if exitcode == 0:
+                            state[name] = fingerprints[name]
+                        else:
+                            state.pop(name, None)
+
+            if 100 in exitcodes.values():  # FATAL, should abort
+                aborted = True
+
+    return [(a['title'], exitcodes[a['name']])
+            for a in actions if a['name'] in exitcodes]
+
+
+# The git mirrors imported from an offline bundle (see `dotfiles bundle`),
+# as url.<mirror>.insteadOf only for the post actions of an offline install.
+MIRROR_GITCONFIG = os.path.join(os.path.expanduser(
+    os.getenv('DOTFILES_CACHE_DIR', '~/.cache/dotfiles')), 'mirrors', 'gitconfig')
+
+def _is_reachable(host='github.com', port=443, timeout=3):
+    import socket
+    try:
+        socket.create_connection((host, port), timeout=timeout).close()
+        return True
+    except OSError:
+        return False
+
+if os.path.isfile(MIRROR_GITCONFIG) and (args.offline or
+                                         args.offline is None and not _is_reachable()):
+    log(YELLOW("Offline: using the git mirrors of %s" % MIRROR_GITCONFIG))
+    os.environ.update(GIT_CONFIG_COUNT='1', GIT_CONFIG_KEY_0='include.path',
+                      GIT_CONFIG_VALUE_0=MIRROR_GITCONFIG)  # git 2.31+
+
+state = load_state()
+try:
+    with tracer.span('phase', 'post_actions'):
+        results = run_post_actions(post_actions, jobs=args.jobs, state=state,
+                                   full=args.full, affected=args.affected_by,
+                                   tracer=tracer)
+finally:
+    save_state(state)
+errors = [title for (title, exitcode) in results if exitcode != 0]
+if any(exitcode == 100 for (_, exitcode) in results):
+    sys.exit(100)
 
+log("\n")
+log_boxed("The slowest steps (see `dotfiles profile-install`)", color_fn=CYAN)
+log(tracer.summary())
 log("\n")
 if errors:
     log_boxed("You have %3d warnings or errors -- check the logs!" % len(errors),
@@ -1,14 +1,65 @@
 """The px module for nvim python rplugins."""
 
 import importlib
+import os
 import sys
+import time
 
+# {module: (mtime_ns, size)} of the source file as of the last (re)load.
+_source_stats = {}
 
-def __import__(module):
-    """Force reload and import a submodule."""
+# {module: (seconds, 'import' | 'reload')} of the last (re)load.
+import_times = {}
+
+
+def _qualify(module):
     if not module.startswith('px.'):
         module = 'px.' + module
+    return module
+
+
+def _source_stat(module):
+    path = getattr(sys.modules.get(module), '__file__', None)
+    try:
+        st = os.stat(path)  # type: ignore
+    except (TypeError, OSError):
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def __import__(module, force=False):
+    """Import a submodule; reload it only if the source file has changed
+    (or force=True) since it was last loaded."""
+    module = _qualify(module)
 
     if module in sys.modules:
+        stat = _source_stat(module)
+        if not force and stat is not None and stat == _source_stats.get(module):
+            return sys.modules[module]
+        action = 'reload'
+        t = time.perf_counter()
         importlib.reload(sys.modules[module])
-    return importlib.import_module(module)
+    else:
+        action = 'import'
+        t = time.perf_counter()
+        importlib.import_module(module)
+
+    import_times[module] = (time.perf_counter() - t, action)
+    _source_stats[module] = _source_stat(module)
+    return sys.modules[module]
+
+
+def reload_all():
+    """Force reload all the px submodules that have been loaded."""
+    modules = sorted(m for m in sys.modules if m.startswith('px.'))
+    for module in modules:
+        __import__(module, force=True)
+    return modules
+
+
+def import_report():
+    """Returns a summary of how long the last (re)load of each submodule took."""
+    lines = []
+    for module, (seconds, action) in sorted(import_times.items()):
+        lines.append("{:<32} {:8.2f} ms  ({})".format(module, seconds * 1000, action))
+    return '\n'.join(lines)
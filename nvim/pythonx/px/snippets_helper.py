@@ -6,7 +6,9 @@
 # Note: Minimum python version is: 3.7+
 from __future__ import annotations
 
-from typing import List, Set
+import dataclasses
+import time
+from typing import Any, List, Optional, Set, Tuple
 
 import vim  # type: ignore
 
@@ -19,6 +21,119 @@ except ImportError:
     pass
 
 
+# Statistics of the side effects (see SideEffects.flush), for each path.
+rpc_stats = {
+    'batched': {'calls': 0, 'flushes': 0, 'round_trips': 0, 'seconds': 0.0},
+    'unbatched': {'calls': 0, 'flushes': 0, 'round_trips': 0, 'seconds': 0.0},
+}
+
+# Set to False (e.g. `:py3 px.snippets_helper.BATCH = False`) to send each
+# side effect as its own blocking request, to compare against rpc_report().
+BATCH = True
+
+
+class SideEffects:
+    """Queues editor side effects (feedkeys, expand, jump) to send them as one
+    nvim_call_atomic batch, instead of a blocking RPC request for each.
+
+    Example:
+    ```
+    with snippets_helper.side_effects() as fx:
+        fx.expand()
+        fx.jump_forward()
+    ```
+    """
+
+    # feedkeys() of the typed keys: <C-R>=...<CR>
+    EXPAND = '\x12=UltiSnips#ExpandSnippet()\r'
+    JUMP_FORWARDS = '\x12=UltiSnips#JumpForwards()\r'
+    JUMP_BACKWARDS = '\x12=UltiSnips#JumpBackwards()\r'
+
+    def __init__(self, sync: bool = False, batch: Optional[bool] = None):
+        self.sync = sync
+        self.batch = BATCH if batch is None else batch
+        self._calls: List[Tuple[str, List[Any]]] = []
+
+    def feedkeys(self, keys: str, mode: str = '') -> SideEffects:
+        """As feedkeys(), `keys` should have been translated already."""
+        self._calls.append(('nvim_feedkeys', [keys, mode, True]))
+        return self
+
+    def expand(self) -> SideEffects:
+        return self.feedkeys(self.EXPAND)
+
+    def jump_forward(self) -> SideEffects:
+        return self.feedkeys(self.JUMP_FORWARDS)
+
+    def jump_backward(self) -> SideEffects:
+        return self.feedkeys(self.JUMP_BACKWARDS)
+
+    def flush(self) -> None:
+        """Send all the queued calls at once; as an asynchronous notification
+        (which does not wait for a response) unless sync=True.
+
+        With batch=False, each call is sent as a blocking request instead."""
+        calls, self._calls = self._calls, []
+        if not calls:
+            return
+        t = time.perf_counter()
+        if not self.batch:
+            for name, args in calls:
+                vim.request(name, *args)
+            stats = rpc_stats['unbatched']
+            stats['round_trips'] += len(calls)
+        elif self.sync:
+            _, err = vim.api.call_atomic(calls)
+            if err:
+                raise RuntimeError("nvim_call_atomic failed: {}".format(err))
+            stats = rpc_stats['batched']
+            stats['round_trips'] += 1
+        else:
+            vim.api.call_atomic(calls, async_=True)
+            stats = rpc_stats['batched']
+        stats['seconds'] += time.perf_counter() - t
+        stats['calls'] += len(calls)
+        stats['flushes'] += 1
+
+    def __enter__(self) -> SideEffects:
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb) -> None:
+        if exc_type is None:
+            self.flush()
+
+
+def side_effects(sync: bool = False,
+                 batch: Optional[bool] = None) -> SideEffects:
+    """Returns a queue of side effects, flushed at the end of the with block."""
+    return SideEffects(sync=sync, batch=batch)
+
+
+def rpc_report() -> str:
+    """The time spent on the side effects, batched and unbatched, and the RPC
+    time the batching saves: the measured latency of an unbatched call times
+    the number of batched calls, minus the time spent in the batched flushes.
+
+    Run some snippets with BATCH = False to measure the unbatched latency."""
+    b, u = rpc_stats['batched'], rpc_stats['unbatched']
+    lines = [
+        "batched:   {calls} side effects in {flushes} flushes, {round_trips} "
+        "blocking round-trips, {ms:.2f} ms".format(ms=b['seconds'] * 1000, **b),
+        "unbatched: {calls} side effects in {round_trips} blocking "
+        "round-trips, {ms:.2f} ms".format(ms=u['seconds'] * 1000, **u),
+    ]
+    if u['calls'] and b['calls']:
+        per_call = u['seconds'] / u['calls']
+        saved = per_call * b['calls'] - b['seconds']
+        lines.append("saved:     {:.2f} ms ({:.3f} ms per unbatched call, "
+                     "{:.3f} ms per batched call)".format(
+                         saved * 1000, per_call * 1000,
+                         b['seconds'] / b['calls'] * 1000))
+    else:
+        lines.append("saved:     n/a (needs both batched and unbatched calls)")
+    return '\n'.join(lines)
+
+
 def snip_expand(snip, jump_pos=1, jump_forward=False):
     """A post-jump action to expand the nested snippet.
 
@@ -37,27 +152,100 @@ def snip_expand(snip, jump_pos=1, jump_forward=False):
     """
     if snip.tabstop != jump_pos:
         return
-    vim.eval(r'feedkeys("\<C-R>=UltiSnips#ExpandSnippet()\<CR>")')
-    if jump_forward:
-        vim.eval(r'feedkeys("\<C-R>=UltiSnips#JumpForwards()\<CR>")')
+    with side_effects() as fx:
+        fx.expand()
+        if jump_forward:
+            fx.jump_forward()
+
+
+def _as_set(type_name: str | List[str] | Set[str]) -> Set[str]:
+    if isinstance(type_name, str):
+        return {type_name}
+    return set(type_name)
+
+
+@dataclasses.dataclass(frozen=True)
+class TSContext:
+    """The treesitter context at the cursor, fetched in a single RPC call."""
+
+    bufnr: int
+    changedtick: int
+    cursor: Tuple[int, int]
+    mode: str
+    types: Tuple[str, ...]  # the node types, from the innermost node to the root
+
+    @property
+    def node_type(self) -> Optional[str]:
+        return self.types[0] if self.types else None
+
+    def on_node(self, type_name: str | List[str] | Set[str]) -> bool:
+        return self.node_type in _as_set(type_name)
+
+    def in_ancestor(self, type_name: str | List[str] | Set[str]) -> bool:
+        """Whether the node or any of its ancestors has the given type."""
+        return not _as_set(type_name).isdisjoint(self.types)
+
+
+_TS_CONTEXT_LUA = '''(function(cached)
+  local ctx = {
+    bufnr = vim.api.nvim_get_current_buf(),
+    changedtick = vim.api.nvim_buf_get_changedtick(0),
+    cursor = vim.api.nvim_win_get_cursor(0),
+    mode = vim.api.nvim_get_mode().mode,
+  }
+  if cached ~= vim.NIL and cached.bufnr == ctx.bufnr and cached.changedtick == ctx.changedtick
+      and cached.cursor[1] == ctx.cursor[1] and cached.cursor[2] == ctx.cursor[2]
+      and cached.mode == ctx.mode then
+    return nil  -- unchanged; no treesitter query
+  end
+  local ok, node = pcall(require("utils.ts_utils").get_node_at_cursor)
+  ctx.types = {}
+  while ok and node do
+    table.insert(ctx.types, node:type())
+    node = node:parent()
+  end
+  return ctx
+end)(_A)'''
+
+_ts_context: Optional[TSContext] = None
+
+
+def ts_context() -> TSContext:
+    """Returns the treesitter context at the cursor, cached.
+
+    A single luaeval checks the cache against (buffer, changedtick, cursor,
+    mode), and runs the treesitter query only if any of them has changed."""
+    global _ts_context
+    c = _ts_context
+    r = vim.funcs.luaeval(_TS_CONTEXT_LUA, c and dict(
+        bufnr=c.bufnr, changedtick=c.changedtick, cursor=list(c.cursor), mode=c.mode))
+    if r is not None:
+        _ts_context = TSContext(
+            bufnr=int(r['bufnr']), changedtick=int(r['changedtick']),
+            cursor=tuple(r['cursor']), mode=r['mode'],
+            types=tuple(r['types'] or ()),
+        )
+    return _ts_context
 
 
 def on_ts_node(type_name: str | List[str] | Set[str]) -> bool:
     """Returns true if the innermost treesitter node on the current cursor
     has the given type."""
+    return ts_context().on_node(type_name)
 
-    if isinstance(type_name, str):
-        type_name = [type_name]
-    type_name = set(type_name)
 
-    node_type: str | None = vim.funcs.luaeval(
-        '''(function(t) return t and t:type() or nil end)(
-            require("utils.ts_utils").get_node_at_cursor() )'''
-    )
-    return node_type in type_name
+def in_ts_ancestor(type_name: str | List[str] | Set[str]) -> bool:
+    """Returns true if the innermost treesitter node on the current cursor,
+    or any of its ancestors, has the given type."""
+    return ts_context().in_ancestor(type_name)
 
 
 __all__ = (
     'snip_expand',
+    'side_effects',
+    'rpc_report',
     'on_ts_node',
+    'in_ts_ancestor',
+    'ts_context',
+    'TSContext',
 )
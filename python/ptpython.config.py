@@ -6,6 +6,8 @@ https://github.com/prompt-toolkit/ptpython/blob/master/examples/ptpython_config/
 """
 # pyright: reportGeneralTypeIssues=false
 
+import os
+
 from prompt_toolkit.filters import ViInsertMode
 from prompt_toolkit.key_binding.key_processor import KeyPress, KeyPressEvent
 from prompt_toolkit.keys import Keys
@@ -19,6 +21,17 @@ from ptpython.layout import CompletionVisualisation
 __all__ = ["configure"]
 
 
+def _import_replhistory():
+    """Import replhistory.py, which is next to this file (~/.config/ptpython/config.py)."""
+    import importlib.util
+    path = os.path.join(os.path.dirname(os.path.realpath(
+        _import_replhistory.__code__.co_filename)), 'replhistory.py')
+    spec = importlib.util.spec_from_file_location('replhistory', path)
+    module = importlib.util.module_from_spec(spec)  # type: ignore
+    spec.loader.exec_module(module)  # type: ignore
+    return module
+
+
 def configure(repl: ptpython.python_input.PythonInput):
     """
     Configuration method. This is called during the start-up of ptpython.
@@ -169,14 +182,26 @@ def configure(repl: ptpython.python_input.PythonInput):
     def _(event: KeyPressEvent):
         event.app.current_buffer.start_completion(select_first=False)
 
+    # History shared with the other ptpython and IPython sessions,
+    # unless REPLHISTORY_SHARED=0 (see replhistory.py)
+    shared_history = None
+    if os.environ.get('REPLHISTORY_SHARED', '1') != '0':
+        from prompt_toolkit.history import ThreadedHistory
+        replhistory = _import_replhistory()
+        shared_history = replhistory.SharedHistory()
+        history_file = getattr(repl.history, 'filename', None) or \
+            getattr(getattr(repl.history, 'history', None), 'filename', None)
+        if history_file and os.path.exists(history_file):
+            with open(history_file, 'rb') as f:  # migrate, only for the first time
+                shared_history.seed(replhistory.parse_file_history(f.read()), 'ptpython')
+        repl.history = ThreadedHistory(shared_history.prompt_history('ptpython'))
+        repl.default_buffer.history = repl.history
+
     # Ctrl-R: History search fzf (requires pyfzf)
     @repl.add_key_binding(Keys.ControlR)
     def _(event: KeyPressEvent):
-        import subprocess, collections
-
-        # REPL history. Oldest item first -> Newest item first
-        lines = event.app.current_buffer.history.get_strings()[::-1]
-        lines = list(collections.OrderedDict.fromkeys(lines))  # uniquify
+        import subprocess
+        replhistory = _import_replhistory()
 
         fzf = subprocess.Popen([
             'fzf',
@@ -186,16 +211,24 @@ def configure(repl: ptpython.python_input.PythonInput):
             "--height", '~30%',
             "+m"
         ], stdout=subprocess.PIPE, stdin=subprocess.PIPE)
-        for line in lines:
-            line = line.replace('\n', '\r')
-            fzf.stdin.write((line + '\n').encode())  # type: ignore
-        fzf.stdin.flush()  # type: ignore
-        fzf_output = fzf.communicate()[0].decode()
+
+        # REPL history, newest item first, streamed from a background thread
+        history = event.app.current_buffer.history
+        history_file = getattr(history, 'filename', None) or \
+            getattr(getattr(history, 'history', None), 'filename', None)
+        if shared_history is not None:
+            shared_history.feed(fzf.stdin)
+        elif history_file:
+            replhistory.HistoryIndex(history_file).feed(fzf.stdin)
+        else:
+            replhistory.feed_strings(history.get_strings(), fzf.stdin)
+        fzf_output = fzf.stdout.read()  # type: ignore
+        fzf.wait()
 
         if fzf_output:
-            fzf_output = fzf_output.replace('\r', '\n').rstrip('\n')
             event.app.current_buffer.text = ''   # clear the input buffer
-            event.app.current_buffer.insert_text(fzf_output, overwrite=True)
+            event.app.current_buffer.insert_text(
+                replhistory.decode(fzf_output), overwrite=True)
 
         event.app.renderer.reset()
 
@@ -2,105 +2,309 @@
 
 # Auto-load common built-in modules that are frequently used
 # For instant startup, non-builtins should be imported upon request (use %imp)
+#
+# PYTHONRC_PROFILE=1: report how long the imports in the startup took.
+# PYTHONRC_BUDGET_MS=N: warn if the startup takes longer than N ms.
 
 # ruff: noqa: F401,E401
 # pyright: reportUnusedImport=false
 
-import asyncio
+import os
+import sys
+import time
+
+_startup_time = time.perf_counter()
+
+
+class _ImportProfiler:
+    """Records the wall time of each import (as -X importtime, but summarized)."""
+
+    def __init__(self):
+        import builtins
+        self._builtins = builtins
+        self._import = builtins.__import__
+        self._stack = []      # the time spent in the nested imports
+        self.records = []     # [(module, cumulative, self, depth)]
+
+    def __import__(self, name, *args, **kwargs):
+        if name in sys.modules:  # not a load, e.g. `from . import` or a cached one
+            return self._import(name, *args, **kwargs)
+        self._stack.append(0.0)
+        t = time.perf_counter()
+        try:
+            return self._import(name, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - t
+            children = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += elapsed
+            self.records.append((name, elapsed, elapsed - children, len(self._stack)))
+
+    def start(self):
+        self._builtins.__import__ = self.__import__
+
+    def stop(self):
+        self._builtins.__import__ = self._import
+
+    def report(self, limit=15):
+        lines = ["%10s %10s  %s" % ('cumul(ms)', 'self(ms)', 'module')]
+        for name, cumul, self_, depth in sorted(
+                self.records, key=lambda r: -r[1])[:limit]:
+            lines.append("%10.2f %10.2f  %s%s" % (
+                cumul * 1000, self_ * 1000, '  ' * depth, name))
+        return '\n'.join(lines)
+
+
+_profiler = None
+if os.environ.get('PYTHONRC_PROFILE'):
+    _profiler = _ImportProfiler()
+    _profiler.start()
+
+
 import contextlib
 import functools
-import hashlib
 import importlib
+import importlib.util
 import io
-import os
 import pathlib
 import re
-import sys
 from importlib import reload
 from pathlib import Path
 
-# Install Jedi completer to readline (tab completion in vanilla python REPL)
-# http://jedi.jedidjah.ch/en/dev/docs/usage.html
-try:
-    from jedi.utils import setup_readline
-    setup_readline()
-except ImportError:
+
+def _lazy_import(name):
+    """Import a module, deferring its execution until the first attribute access."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# Rarely used; loaded on first access
+asyncio = _lazy_import('asyncio')
+hashlib = _lazy_import('hashlib')
+
+
+def _setup_completer():
+    """Install Jedi completer to readline (tab completion in vanilla python REPL),
+    which is imported upon the first completion (i.e. TAB)."""
+    # http://jedi.jedidjah.ch/en/dev/docs/usage.html
     import readline, rlcompleter   # isort:skip
     readline.parse_and_bind("tab: complete")
+    if importlib.util.find_spec('jedi') is None:
+        return
+
+    def _complete(text, state):
+        readline.set_completer(None)
+        from jedi.utils import setup_readline
+        setup_readline()
+        return readline.get_completer()(text, state)
+
+    readline.set_completer_delims('')  # as in jedi's, the whole line is the text
+    readline.set_completer(_complete)
+
 
-# https://github.com/laike9m/pdir2
 try:
-    import pdir
+    _setup_completer()
 except ImportError:
     pass
 
 
-def _import_common_modules(full=False):
-    """Import common modules such as numpy, pandas, etc."""
+# https://github.com/laike9m/pdir2
+if importlib.util.find_spec('pdir') is not None:
+    def pdir(*args, **kwargs):
+        """pdir2, which is imported upon the first call."""
+        import pdir as _pdir
+        globals()['pdir'] = _pdir
+        return _pdir(*args, **kwargs)
 
-    def _import(module_name, symbol=None, _as=None, verbose=True):
-        try:
-            if not symbol:
-                msg = "import {}{}".format(
-                    module_name, _as and (' as ' + _as) or '')
-            else:
-                msg = "from {} import {}{}".format(
-                    module_name, symbol, _as and (' as ' + _as) or '')
-            sys.stdout.write("%-35s" % msg)
-            sys.stdout.flush()
 
+class _LazyModule:
+    """A proxy of a module (or a symbol) that is being imported in background.
+
+    Touching it waits for that import only; the proxy is replaced with the
+    real object in the namespace (see _Preloader.install)."""
+
+    __slots__ = ('_name', '_future', '_preloader')
+
+    def __init__(self, name, future, preloader):
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_future', future)
+        object.__setattr__(self, '_preloader', preloader)
+
+    def _resolve(self):
+        obj = self._future.result()  # may raise ImportError
+        self._preloader.install(self._name)
+        return obj
+
+    def __getattr__(self, attr):
+        return getattr(self._resolve(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._resolve(), attr, value)
+
+    def __dir__(self):
+        return dir(self._resolve())
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+    def __repr__(self):
+        if not self._future.done():
+            return "<lazy {!r} (importing...)>".format(self._name)
+        return repr(self._resolve())
+
+
+class _Preloader:
+    """Imports modules in a background thread, binding lazy proxies.
+
+    The imports run one at a time: concurrent imports of interdependent
+    packages (e.g. jax and jax.numpy) may deadlock or see a partially
+    initialized module."""
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        self.futures = {}   # {name: Future}
+        self.modules = {}   # {name: module}
+        self.timings = {}   # {name: seconds}
+        self.hooks = {}     # {name: callable}, to run once (main thread) it's installed
+        self._executor = None
+        self._install_on_pre_run_cell = False
+
+    def _import(self, name, module_name, symbol):
+        import time
+        t = time.perf_counter()
+        try:
             m = importlib.import_module(module_name)
-            obj_or_m = getattr(m, symbol) if symbol else m
-            if _as:
-                globals()[_as] = obj_or_m
-            elif symbol:
-                globals()[symbol] = obj_or_m
-            else:
-                tl_package = module_name.split('.')[0]
-                globals()[tl_package] = sys.modules[tl_package]
-            if verbose:
-                tl_package = module_name.split('.')[0]
-                version = getattr(sys.modules[tl_package], '__version__', '')
-                sys.stdout.write(version and ('[' + version + ']') or '')
-        except ImportError:
-            sys.stdout.write('not found')
-            return
+            return getattr(m, symbol) if symbol else m
         finally:
-            sys.stdout.write('\n')
-            sys.stdout.flush()
-
-    _import('numpy', _as='np')
-    _import('jax')
-    _import('jax.numpy', _as='jnp')
-    _import('pandas', _as='pd')
-    _import('matplotlib', _as='mpl')
-    _import('matplotlib.pyplot', _as='plt')
-    _import('scipy')
-    _import('imgcat', symbol='imgcat')
-    _import('tqdm.auto', symbol='tqdm')
+            self.timings[name] = time.perf_counter() - t
+
+    @staticmethod
+    def _load_lazy_modules():
+        # LazyLoader is not thread-safe (before python 3.12), and the
+        # background imports may touch the modules of _lazy_import().
+        for m in list(sys.modules.values()):
+            if isinstance(m, importlib.util._LazyModule):  # pylint: disable=protected-access
+                getattr(m, '__file__', None)
+
+    def load(self, specs):
+        """specs: [(name, module, symbol, estimated cost in seconds)].
 
+        The cheapest imports are submitted first, to be ready soonest."""
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._load_lazy_modules()
+            self._executor = ThreadPoolExecutor(1, thread_name_prefix='pythonrc')
+        names = []
+        for name, module_name, symbol, _ in sorted(specs, key=lambda s: s[3]):
+            if name in self.futures or (name in self.namespace and
+                                        not isinstance(self.namespace[name], _LazyModule)):
+                continue  # already imported or being imported
+            self.modules[name] = module_name
+            self.futures[name] = self._executor.submit(self._import, name, module_name, symbol)
+            self.namespace[name] = _LazyModule(name, self.futures[name], self)
+            names.append(name)
+        return names
+
+    def install(self, name=None):
+        """Replace the proxies of the finished imports with the real objects."""
+        import threading
+        if threading.current_thread() is not threading.main_thread():
+            return
+        for n in ([name] if name else list(self.futures)):
+            future = self.futures.get(n)
+            if future is None or not future.done():
+                continue
+            del self.futures[n]
+            if isinstance(self.namespace.get(n), _LazyModule):
+                if future.exception() is None:
+                    self.namespace[n] = future.result()
+                else:
+                    del self.namespace[n]
+            hook = self.hooks.pop(n, None)
+            if hook and future.exception() is None:
+                hook()
+
+    def report(self):
+        lines = []
+        for name, module_name in self.modules.items():
+            future = self.futures.get(name)
+            if future is not None and not future.done():
+                status, elapsed = 'importing...', ''
+            else:
+                if name not in self.namespace:
+                    status = 'not found'
+                else:
+                    m = sys.modules.get(module_name.split('.')[0])
+                    status = getattr(m, '__version__', '') or 'ok'
+                elapsed = '%8.3f s' % self.timings.get(name, 0.0)
+            lines.append("%-8s %-22s %10s  %s" % (name, module_name, elapsed, status))
+        return '\n'.join(lines)
+
+
+# (name, module, symbol, estimated import cost in seconds)
+_COMMON_MODULES = [
+    ('np', 'numpy', None, 0.1),
+    ('jax', 'jax', None, 1.5),
+    ('jnp', 'jax.numpy', None, 1.5),
+    ('pd', 'pandas', None, 0.5),
+    ('mpl', 'matplotlib', None, 0.2),
+    ('plt', 'matplotlib.pyplot', None, 0.4),
+    ('scipy', 'scipy', None, 0.05),
+    ('imgcat', 'imgcat', 'imgcat', 0.01),
+    ('tqdm', 'tqdm.auto', 'tqdm', 0.1),
+]
+
+_preloader = None
+
+
+def _import_common_modules(full=False):
+    """Import common modules such as numpy, pandas, etc. in background."""
+    global _preloader
+    if _preloader is None:
+        _preloader = _Preloader(globals())
+    specs = list(_COMMON_MODULES)
     if full:   # %imp -a
-        _import('tensorflow', _as='tf')
+        specs.append(('tf', 'tensorflow', None, 3.0))
+    names = _preloader.load(specs)
+    if names:
+        print("Importing in background: {}  (see %i --timings)".format(', '.join(names)))
 
 
 def _import_common_magics():
     ipy = get_ipython()  # pylint: disable=undefined-variable
 
-    def _run(line):
-        ipy.run_cell('''\
-try:
-    {line}
-    print('{line}')
-except ModuleNotFoundError:
-    pass'''.format(line=line))
-
-    _run(r'%matplotlib inline')
-    _run(r'%config InlineBackend.figure_format = "retina"')
+    # run_line_magic, not run_cell: the matplotlib magics may run from
+    # a pre_run_cell hook, i.e. in the middle of another cell's execution.
+    def _run(magic, line):
+        try:
+            ipy.run_line_magic(magic, line)
+            print('%{} {}'.format(magic, line))
+        except ModuleNotFoundError:
+            pass
 
-    _run(r'%load_ext autoreload')
-    _run(r'%load_ext imgcat')
-    _run(r'%load_ext line_profiler')
+    # matplotlib is being imported in background; configure it once it's there
+    def _matplotlib_magics():
+        _run('matplotlib', 'inline')
+        _run('config', 'InlineBackend.figure_format = "retina"')
+    if _preloader is not None and 'plt' in _preloader.futures:
+        _preloader.hooks['plt'] = _matplotlib_magics
+        if not _preloader._install_on_pre_run_cell:
+            ipy.events.register('pre_run_cell', lambda *args: _preloader.install())
+            _preloader._install_on_pre_run_cell = True
+    else:
+        _matplotlib_magics()
 
+    _run('load_ext', 'autoreload')
+    _run('load_ext', 'imgcat')
+    _run('load_ext', 'line_profiler')
 
 def _import_common(full=False):
     _import_common_modules(full=full)
@@ -116,10 +320,49 @@ try:
 
     @register_line_magic
     def i(line):
-        """%i: Magic for loading common packages you would need."""
+        """%i: Magic for loading common packages you would need.
+
+        %i -a: also import tensorflow.
+        %i --timings: show how long each import took.
+        """
+        if line.strip() == '--timings':
+            print(_preloader.report() if _preloader else "Not loaded yet; run %i first.")
+            return
         _import_common(line.strip() == '-a')
 
     del register_line_magic
 
+    # Share the inputs with the ptpython history (see replhistory.py)
+    def _share_history(result, _path=os.path.join(
+            os.path.dirname(os.path.realpath(__file__)), 'replhistory.py')):
+        global _shared_history
+        raw_cell = result.info.raw_cell if result.info else None
+        if not raw_cell or os.environ.get('REPLHISTORY_SHARED', '1') == '0':
+            return
+        if _shared_history is None:
+            spec = importlib.util.spec_from_file_location('replhistory', _path)
+            replhistory = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(replhistory)
+            _shared_history = replhistory.SharedHistory()
+        _shared_history.append(raw_cell.rstrip('\n'), source='ipython')
+
+    _shared_history = None
+    get_ipython().events.register('post_run_cell', _share_history)
+
 except NameError:
     pass  # not ipython, don't do anything
+
+
+def _report_startup():
+    elapsed_ms = (time.perf_counter() - _startup_time) * 1000
+    budget_ms = os.environ.get('PYTHONRC_BUDGET_MS')
+    if _profiler is not None:
+        _profiler.stop()
+        sys.stderr.write(_profiler.report() + '\n')
+        sys.stderr.write("pythonrc: startup took %.1f ms\n" % elapsed_ms)
+    if budget_ms and elapsed_ms > float(budget_ms):
+        sys.stderr.write("pythonrc: startup took %.1f ms, over the budget of %s ms "
+                         "(see PYTHONRC_PROFILE=1)\n" % (elapsed_ms, budget_ms))
+
+
+_report_startup()
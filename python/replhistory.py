@@ -0,0 +1,392 @@
+"""
+replhistory: REPL history stores and indexes for ptpython and IPython.
+
+SharedHistory is a size-bounded history store shared across the sessions of
+ptpython and IPython (see pythonrc.py): an append-only log, compacted by
+evicting the least recently used entries when the log grows over a size
+limit. search() builds an in-memory prefix and trigram index, upon the first
+search only.
+
+HistoryIndex is a persisted index of a ptpython history file (FileHistory)
+for the fzf picker (Ctrl-R). The index is de-duplicated and ordered newest first. It is built from the
+ptpython history file (prompt_toolkit's FileHistory), and updated
+incrementally: only the entries appended since the last update are parsed.
+An entry is stored as one line, where newlines are encoded as '\\r' (the form
+fzf reads), so the index is streamed to fzf as is, in large chunks.
+
+See ~/.config/ptpython/config.py.
+"""
+
+import bisect
+import os
+import threading
+import time
+from typing import IO, Dict, Iterable, List, Optional, Set, Tuple
+
+INDEX_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'replhistory')
+MAGIC = b'#replhistory-v1'
+SHARED_HISTORY_FILE = os.path.join(
+    os.environ.get('XDG_DATA_HOME') or os.path.expanduser('~/.local/share'),
+    'replhistory', 'history.log')
+CHUNK_SIZE = 1 << 16
+
+
+def encode(entry: str) -> bytes:
+    """An entry as a line of the index (and of the fzf input)."""
+    return entry.replace('\n', '\r').encode('utf-8', 'surrogateescape') + b'\n'
+
+
+def decode(line: bytes) -> str:
+    """The inverse of encode(), e.g. for the output of fzf."""
+    return line.rstrip(b'\n').decode('utf-8', 'surrogateescape').replace('\r', '\n')
+
+
+def parse_file_history(data: bytes) -> List[bytes]:
+    """Parse prompt_toolkit's FileHistory, returning the encoded entries
+    (oldest first). `data` should start at the beginning of an entry."""
+    entries, lines = [], []
+    for line in data.split(b'\n'):
+        if line.startswith(b'+'):
+            lines.append(line[1:])
+        elif lines:
+            entries.append(b'\r'.join(lines) + b'\n')
+            lines = []
+    if lines:
+        entries.append(b'\r'.join(lines) + b'\n')
+    return entries
+
+
+def newest_first(entries: Iterable[bytes]) -> List[bytes]:
+    """De-duplicate the entries (oldest first), keeping the newest ones."""
+    return list(dict.fromkeys(reversed(list(entries))))
+
+
+class HistoryIndex:
+    """The index of a ptpython history file, updated upon stream()."""
+
+    def __init__(self, history_file: str, index_file: Optional[str] = None):
+        self.history_file = os.path.realpath(os.path.expanduser(history_file))
+        if index_file is None:
+            index_file = os.path.join(
+                INDEX_DIR, self.history_file.strip(os.sep).replace(os.sep, '%') + '.idx')
+        self.index_file = os.path.abspath(index_file)
+
+    def _read_header(self, f: IO[bytes]) -> Optional[Tuple[int, int]]:
+        """Returns the (inode, offset) of the history file that has been indexed."""
+        header = f.readline().split()
+        if len(header) != 3 or header[0] != MAGIC:
+            return None
+        return int(header[1]), int(header[2])
+
+    def _new_entries(self, indexed: Optional[Tuple[int, int]]):
+        """Returns (entries, inode, offset, rebuild) where entries are the
+        new (or all, if rebuild) encoded entries, newest first."""
+        try:
+            f = open(self.history_file, 'rb')
+        except OSError:
+            return [], 0, 0, indexed is not None
+        with f:
+            st = os.fstat(f.fileno())
+            rebuild = indexed is None or indexed[0] != st.st_ino or indexed[1] > st.st_size
+            offset = 0 if rebuild else indexed[1]  # type: ignore
+            f.seek(offset)
+            data = f.read()
+        return newest_first(parse_file_history(data)), st.st_ino, offset + len(data), rebuild
+
+    def stream(self, out: Optional[IO[bytes]]) -> None:
+        """Write the index (newest first) to `out` in chunks, updating the
+        index file at the same time.
+
+        Writing to `out` stops (but the update continues) if it is closed,
+        e.g. when fzf has exited."""
+        def write(chunk: bytes):
+            nonlocal out
+            if out is not None and chunk:
+                try:
+                    out.write(chunk)
+                except (BrokenPipeError, ValueError):
+                    out = None
+
+        try:
+            index = open(self.index_file, 'rb')
+        except OSError:
+            index = None
+        try:
+            indexed = self._read_header(index) if index else None
+            entries, inode, offset, rebuild = self._new_entries(indexed)
+
+            fresh = b''.join(entries)
+            write(fresh)
+            if not entries and not rebuild:
+                # nothing has changed: copy the index as is
+                while index is not None and out is not None:
+                    chunk = index.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    write(chunk)
+                return
+
+            os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+            tmp = '%s.%d.tmp' % (self.index_file, os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(b'%s %d %d\n' % (MAGIC, inode, offset))
+                f.write(fresh)
+                # the older entries, except for the ones that became newer
+                seen, rest = set(entries), b''
+                while index is not None and not rebuild:
+                    chunk = index.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    lines = (rest + chunk).split(b'\n')
+                    rest = lines.pop()
+                    chunk = b''.join(line + b'\n' for line in lines
+                                     if line + b'\n' not in seen)
+                    write(chunk)
+                    f.write(chunk)
+            os.replace(tmp, self.index_file)
+        finally:
+            if index is not None:
+                index.close()
+            if out is not None:
+                try:
+                    out.close()
+                except BrokenPipeError:
+                    pass
+
+    def feed(self, out: IO[bytes]) -> threading.Thread:
+        """stream() in a background thread."""
+        thread = threading.Thread(target=self.stream, args=(out,),
+                                  name='replhistory', daemon=False)
+        thread.start()
+        return thread
+
+
+def _feed_lines(get_lines, out: IO[bytes]) -> threading.Thread:
+    """Write the lines from get_lines() to `out` in chunks, in a background thread."""
+    def _stream():
+        try:
+            lines = get_lines()
+            for i in range(0, len(lines), 4096):
+                out.write(b''.join(lines[i:i + 4096]))
+            out.close()
+        except (BrokenPipeError, ValueError):
+            pass
+    thread = threading.Thread(target=_stream, name='replhistory', daemon=True)
+    thread.start()
+    return thread
+
+
+def feed_strings(strings: List[str], out: IO[bytes]) -> threading.Thread:
+    """Stream history strings (oldest first) without an index, e.g. for an
+    in-memory history."""
+    return _feed_lines(lambda: newest_first(encode(s) for s in strings), out)
+
+
+class SharedHistory:
+    """A history store shared across REPL sessions (and tools).
+
+    The log is append-only, a line per record: `<timestamp>\\t<source>\\t<entry>`
+    where the entry is encoded as in encode(). entries() reads the log as is;
+    the index for search() is built upon the first search, and the records
+    from the other sessions are added to it upon every search.
+
+    When the log grows over `max_bytes`, it is compacted: only the latest
+    record of each entry is kept, and the least recently used entries are
+    evicted down to 3/4 of `max_bytes`.
+    """
+
+    def __init__(self, path: str = SHARED_HISTORY_FILE, max_bytes: int = 4 << 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()  # of the index; e.g. a history loader thread
+        self._reset()
+
+    def _reset(self):
+        self._inode = None
+        self._offset = 0
+        self._recency: Dict[bytes, int] = {}   # {entry: seq}, the oldest first
+        self._sorted: List[bytes] = []         # entries, for the prefix search
+        self._trigrams: Dict[bytes, Set[bytes]] = {}
+        self._seq = 0
+
+    # index
+
+    def _add(self, entry: bytes, insort: bool = True):
+        if entry in self._recency:
+            del self._recency[entry]  # move to the end (the newest)
+        else:
+            if insort:
+                bisect.insort(self._sorted, entry)
+            for i in range(len(entry) - 2):
+                self._trigrams.setdefault(entry[i:i + 3], set()).add(entry)
+        self._seq += 1
+        self._recency[entry] = self._seq
+
+    def refresh(self) -> None:
+        """Index the records appended (by any session) since the last refresh."""
+        with self._lock:
+            self._refresh()
+
+    def _refresh(self) -> None:
+        try:
+            f = open(self.path, 'rb')
+        except OSError:
+            self._reset()
+            return
+        with f:
+            st = os.fstat(f.fileno())
+            if st.st_ino != self._inode or st.st_size < self._offset:
+                self._reset()  # compacted or truncated
+                self._inode = st.st_ino
+            f.seek(self._offset)
+            data = f.read()
+        end = data.rfind(b'\n') + 1  # the last record may be being written
+        fresh = not self._recency  # sort once, rather than insort each
+        for record in data[:end].split(b'\n')[:-1]:
+            entry = record.split(b'\t', 2)[-1]
+            if entry:
+                self._add(entry + b'\n', insort=not fresh)
+        if fresh:
+            self._sorted = sorted(self._recency)
+        self._offset += end
+
+    # store
+
+    def append(self, entry: str, source: str = '') -> None:
+        """Append an entry to the log (atomically, with a single write).
+
+        The appends share the lock that compact() and seed() hold exclusively,
+        so that no record is written to a log that is being replaced."""
+        import fcntl
+        if not entry.strip():
+            return
+        record = b'%d\t%s\t' % (int(time.time()), source.encode()) + encode(entry)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            try:
+                os.write(fd, record)
+                size = os.fstat(fd).st_size
+            finally:
+                os.close(fd)
+        if size > self.max_bytes:
+            self.compact()
+
+    def seed(self, entries: Iterable[bytes], source: str = '') -> None:
+        """Import the encoded entries (oldest first) of an existing history,
+        e.g. from parse_file_history(), as older than the log; once per source."""
+        import fcntl
+        marker = '%s.seeded-%s' % (self.path, source)
+        if os.path.exists(marker):
+            return
+        prefix = b'%d\t%s\t' % (int(time.time()), source.encode())
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.path, 'rb') as f:
+                    log = f.read()
+            except OSError:
+                log = b''
+            tmp = '%s.%d.tmp' % (self.path, os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(b''.join(prefix + e for e in entries) + log)
+            os.chmod(tmp, 0o600)
+            os.replace(tmp, self.path)
+            open(marker, 'w').close()
+        if os.path.getsize(self.path) > self.max_bytes:
+            self.compact()
+
+    def compact(self) -> None:
+        """Rewrite the log with the most recently used entries only."""
+        import fcntl
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            with open(self.path, 'rb') as f:
+                records = f.read().split(b'\n')[:-1]
+            if sum(len(r) + 1 for r in records) <= self.max_bytes:
+                return  # compacted by another session
+            latest: Dict[bytes, bytes] = {}
+            for record in records:
+                entry = record.split(b'\t', 2)[-1]
+                latest.pop(entry, None)
+                latest[entry] = record
+            kept, size = [], 0
+            for record in reversed(list(latest.values())):
+                size += len(record) + 1
+                if size > self.max_bytes * 3 // 4:
+                    break
+                kept.append(record)
+            tmp = '%s.%d.tmp' % (self.path, os.getpid())
+            with open(tmp, 'wb') as f:
+                f.write(b''.join(r + b'\n' for r in reversed(kept)))
+            os.chmod(tmp, 0o600)
+            os.replace(tmp, self.path)
+
+    # search
+
+    def __len__(self) -> int:
+        return len(self.entries())
+
+    def entries(self) -> List[bytes]:
+        """All the (encoded) entries, the newest first; read from the log,
+        without the index."""
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return []
+        data = data[:data.rfind(b'\n') + 1]  # the last record may be being written
+        entries = (record.split(b'\t', 2)[-1] for record in data.split(b'\n')[:-1])
+        return newest_first(e + b'\n' for e in entries if e)
+
+    def search(self, query: str, prefix: bool = False, limit: Optional[int] = None) -> List[str]:
+        """Entries that contain (or start with, if prefix=True) the query,
+        the most recently used first."""
+        with self._lock:
+            self._refresh()
+            return self._search(query, prefix, limit)
+
+    def _search(self, query: str, prefix: bool, limit: Optional[int]) -> List[str]:
+        q = encode(query)[:-1]
+        if not prefix and len(q) < 3:
+            # no trigrams to look up; scan from the newest, until the limit
+            matches = []
+            for e in reversed(self._recency):
+                if q in e:
+                    matches.append(e)
+                    if len(matches) == limit:
+                        break
+            return [decode(e) for e in matches]
+        if prefix:
+            lo = bisect.bisect_left(self._sorted, q)
+            hi = bisect.bisect_left(self._sorted, q + b'\xff')
+            matches = self._sorted[lo:hi]
+        else:
+            postings = sorted((self._trigrams.get(q[i:i + 3], set())
+                               for i in range(len(q) - 2)), key=len)
+            candidates = set.intersection(*postings)
+            matches = [e for e in candidates if q in e]
+        matches.sort(key=self._recency.__getitem__, reverse=True)
+        return [decode(e) for e in matches[:limit]]
+
+    def feed(self, out: IO[bytes]) -> threading.Thread:
+        """Stream all the entries (newest first) in a background thread."""
+        return _feed_lines(self.entries, out)
+
+    def prompt_history(self, source: str = 'ptpython'):
+        """A prompt_toolkit History backed by this store, e.g. for ptpython."""
+        from prompt_toolkit.history import History
+        store = self
+
+        class _SharedPromptHistory(History):
+            def load_history_strings(self):
+                for entry in store.entries():
+                    yield decode(entry)
+
+            def store_string(self, string: str) -> None:
+                store.append(string, source=source)
+
+        return _SharedPromptHistory()
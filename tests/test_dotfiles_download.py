@@ -0,0 +1,98 @@
+"""Tests of the download cache of bin/dotfiles, against a local HTTP server."""
+
+import http.server
+import importlib.machinery
+import importlib.util
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+import urllib.error
+
+BIN_DOTFILES = os.path.join(os.path.dirname(__file__), '..', 'bin', 'dotfiles')
+
+RELEASES = [{'tag_name': 'v1.0', 'assets': [
+    {'name': 'foo-linux.tar.gz', 'browser_download_url': '/download/foo-linux.tar.gz'}]}]
+
+
+class FixtureHandler(http.server.BaseHTTPRequestHandler):
+    """Serves RELEASES with an ETag, or the status in `server.status`."""
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.server.status != 200:
+            self.send_error(self.server.status)
+            return
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = json.dumps(RELEASES).encode()
+        self.send_response(200)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ReleaseMetadataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.HTTPServer(('127.0.0.1', 0), FixtureHandler)
+        self.server.status = 200
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.cache_dir = tempfile.TemporaryDirectory()
+
+        os.environ['DOTFILES_GITHUB_API_URL'] = 'http://127.0.0.1:%d' % self.server.server_port
+        os.environ['DOTFILES_CACHE_DIR'] = self.cache_dir.name
+        loader = importlib.machinery.SourceFileLoader('dotfiles', BIN_DOTFILES)
+        self.dotfiles = importlib.util.module_from_spec(
+            importlib.util.spec_from_loader('dotfiles', loader))
+        loader.exec_module(self.dotfiles)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.cache_dir.cleanup()
+        del os.environ['DOTFILES_GITHUB_API_URL'], os.environ['DOTFILES_CACHE_DIR']
+
+    def expire_cache(self):
+        path = self.dotfiles._release_metadata_path('foo/bar')
+        with open(path) as f:
+            cached = json.load(f)
+        cached['fetched_at'] = time.time() - self.dotfiles.RELEASE_METADATA_TTL - 1
+        with open(path, 'w') as f:
+            json.dump(cached, f)
+
+    def test_cached_within_ttl(self):
+        self.assertEqual(self.dotfiles.fetch_release_metadata('foo/bar'), RELEASES)
+        self.assertEqual(self.dotfiles.fetch_release_metadata('foo/bar'), RELEASES)
+        self.assertEqual(self.server.requests, ['/repos/foo/bar/releases'])
+
+    def test_revalidated_with_etag(self):
+        self.dotfiles.fetch_release_metadata('foo/bar')
+        self.expire_cache()
+        self.assertEqual(self.dotfiles.fetch_release_metadata('foo/bar'), RELEASES)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_http_error_falls_back_to_cache(self):
+        self.dotfiles.fetch_release_metadata('foo/bar')
+        self.expire_cache()
+        for status in (403, 500):
+            self.server.status = status
+            self.assertEqual(self.dotfiles.fetch_release_metadata('foo/bar'), RELEASES)
+
+    def test_http_error_without_cache(self):
+        self.server.status = 403
+        with self.assertRaises(urllib.error.HTTPError):
+            self.dotfiles.fetch_release_metadata('foo/bar')
+
+
+if __name__ == '__main__':
+    unittest.main()
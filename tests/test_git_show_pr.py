@@ -0,0 +1,104 @@
+"""Tests of `git show-pr --index`, on a local repository and a --fixture."""
+
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import unittest
+
+GIT_SHOW_PR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin', 'git-show-pr')
+
+PULLS = [
+    {'number': 10, 'title': 'Feature A', 'html_url': 'https://github.com/o/r/pull/10',
+     'updated_at': '2020-01-01T00:00:00Z', 'merge_commit_sha': None, 'head': {'sha': None}},
+    {'number': 12, 'title': 'Feature C', 'html_url': 'https://github.com/o/r/pull/12',
+     'updated_at': '2020-01-03T00:00:00Z', 'merge_commit_sha': None, 'head': {'sha': None}},
+]
+
+
+class GitShowPrIndexTest(unittest.TestCase):
+
+    def git(self, *args):
+        return subprocess.check_output(('git',) + args, cwd=self.repo,
+                                       universal_newlines=True).strip()
+
+    def commit(self, message):
+        self.git('commit', '-q', '--allow-empty', '-m', message)
+        return self.git('rev-parse', 'HEAD')
+
+    def merge(self, branch, message):
+        self.git('merge', '-q', '--no-ff', '-m', message, branch)
+        return self.git('rev-parse', 'HEAD')
+
+    def show_pr(self, *args, **kwargs):
+        return subprocess.check_output(
+            [sys.executable, GIT_SHOW_PR, '--fixture', self.fixture] + list(args),
+            cwd=self.repo, universal_newlines=True, **kwargs)
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.repo = os.path.join(self.tmp.name, 'r')
+        self.fixture = os.path.join(self.tmp.name, 'pulls.json')
+        os.environ.update(GIT_AUTHOR_NAME='a', GIT_AUTHOR_EMAIL='a@b',
+                          GIT_COMMITTER_NAME='a', GIT_COMMITTER_EMAIL='a@b')
+        subprocess.check_call(['git', 'init', '-q', '-b', 'main', self.repo])
+        with open(self.fixture, 'w') as f:
+            json.dump(PULLS, f)
+
+        c = self.c = {}
+        c['root'] = self.commit('root')
+        # feature A, which merges main in the middle
+        self.git('checkout', '-q', '-b', 'a')
+        c['a1'] = self.commit('feature a 1')
+        self.git('checkout', '-q', 'main')
+        c['direct1'] = self.commit('direct push')
+        self.git('checkout', '-q', 'a')
+        self.merge('main', "Merge branch 'main' into a")
+        c['a2'] = self.commit('feature a 2')
+        # feature B, branched off feature A (merged later)
+        self.git('checkout', '-q', '-b', 'b')
+        c['b1'] = self.commit('feature b 1')
+        self.git('checkout', '-q', 'main')
+        c['merge_a'] = self.merge('a', 'Merge pull request #10 from o/a')
+        c['squash'] = self.commit('Squashed change (#11)')
+        c['merge_b'] = self.merge('b', 'Merge pull request #12 from o/b')
+        c['direct2'] = self.commit('another direct push')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def lookup(self, name):
+        """e.g. '#10', or None if no PR is found."""
+        try:
+            return self.show_pr(self.c[name], stderr=subprocess.DEVNULL).split()[0]
+        except subprocess.CalledProcessError:
+            return None
+
+    def test_index(self):
+        self.show_pr('--index')
+        expected = {'root': None, 'direct1': None, 'direct2': None,
+                    'a1': '#10', 'a2': '#10', 'merge_a': '#10',
+                    'b1': '#12', 'merge_b': '#12', 'squash': '#11'}
+        for name, pr in expected.items():
+            self.assertEqual(self.lookup(name), pr, name)
+
+    def test_incremental_index(self):
+        self.show_pr('--index')
+        self.git('checkout', '-q', '-b', 'd', self.c['direct2'])
+        self.c['d1'] = self.commit('feature d 1')
+        self.git('checkout', '-q', 'main')
+        self.c['merge_d'] = self.merge('d', 'Merge pull request #13 from o/d')
+        self.show_pr('--index')
+        self.assertEqual(self.lookup('d1'), '#13')
+        self.assertEqual(self.lookup('a1'), '#10')
+
+        log = self.git('log', '--format=%h %s')
+        annotated = re.sub(r'\033\[[0-9;]*m', '', self.show_pr('--stdin', input=log))
+        self.assertIn('feature d 1 (#13)', annotated)
+        self.assertIn('Squashed change (#11)\n', annotated)
+
+
+if __name__ == '__main__':
+    unittest.main()